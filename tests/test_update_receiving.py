@@ -3,10 +3,13 @@ import json
 import os
 import pytest
 import responses
+import threading
+import time
 import urllib.parse
 from enum import Enum
 
-from tinytextbot import telegram, analytics, application
+from tinytextbot import telegram, analytics, application, deadline, \
+    workers, metrics, bot, shutdown, tracing, profiling
 
 TELEGRAM_TOKEN = os.environ["TELEGRAM_TOKEN"]
 ANALYTICS_TOKEN = os.environ["ANALYTICS_TOKEN"]
@@ -126,8 +129,10 @@ class BaseTest(object):
         telegram_request = calls[call_position].request
         assert self.correct_telegram_method in telegram_request.url
 
-        correct_telegram_json = json.dumps(self.correct_telegram_json)
-        assert telegram_request.body.decode(UTF8) == correct_telegram_json
+        # The codec may encode more compactly than json.dumps,
+        # so compare the decoded payloads instead.
+        telegram_json = json.loads(telegram_request.body.decode(UTF8))
+        assert telegram_json == self.correct_telegram_json
 
     def test_analytics_message_received(self, calls):
         if not self.correct_params_for_received:
@@ -185,6 +190,7 @@ class TestMessage(BaseTest):
 
     correct_params_for_received = {
         Params.VERSION.value: 1,
+        Params.SAMPLE_WEIGHT.value: 1,
         Params.TOKEN_ID.value: ANALYTICS_TOKEN,
         Params.TYPE.value: Params.EVENT.value,
         Params.EVENT_ACTION.value: analytics.Event.Action.MESSAGE.value,
@@ -197,6 +203,7 @@ class TestMessage(BaseTest):
 
     correct_params_for_sent = {
         Params.VERSION.value: 1,
+        Params.SAMPLE_WEIGHT.value: 1,
         Params.TOKEN_ID.value: ANALYTICS_TOKEN,
         Params.TYPE.value: Params.EVENT.value,
         Params.EVENT_ACTION.value: analytics.Event.Action.INSTRUCTIONS.value,
@@ -225,6 +232,7 @@ class TestUnsuccessfulReplyToMessage(BaseTest):
 
     correct_params_for_sent = {
         Params.VERSION.value: 1,
+        Params.SAMPLE_WEIGHT.value: 1,
         Params.TOKEN_ID.value: ANALYTICS_TOKEN,
         Params.TYPE.value: Params.EVENT.value,
         Params.EVENT_ACTION.value: analytics.Event.Action.FAILED.value,
@@ -258,6 +266,7 @@ class TestStartMessage(BaseTest):
 
     correct_params_for_received = {
         Params.VERSION.value: 1,
+        Params.SAMPLE_WEIGHT.value: 1,
         Params.TOKEN_ID.value: ANALYTICS_TOKEN,
         Params.TYPE.value: Params.EVENT.value,
         Params.EVENT_ACTION.value: analytics.Event.Action.START.value,
@@ -271,6 +280,7 @@ class TestStartMessage(BaseTest):
 
     correct_params_for_sent = {
         Params.VERSION.value: 1,
+        Params.SAMPLE_WEIGHT.value: 1,
         Params.TOKEN_ID.value: ANALYTICS_TOKEN,
         Params.TYPE.value: Params.EVENT.value,
         Params.EVENT_ACTION.value: analytics.Event.Action.GREETINGS.value,
@@ -299,6 +309,7 @@ class TestUnsuccessfulReplyToStartMessage(BaseTest):
 
     correct_params_for_sent = {
         Params.VERSION.value: 1,
+        Params.SAMPLE_WEIGHT.value: 1,
         Params.TOKEN_ID.value: ANALYTICS_TOKEN,
         Params.TYPE.value: Params.EVENT.value,
         Params.EVENT_ACTION.value: analytics.Event.Action.FAILED.value,
@@ -330,10 +341,13 @@ class TestInlineQuery(BaseTest):
                      "title": "Choose this to send your tiny text!",
                      "description": "ᵗᵉˣᵗ ᵗᵒ ᵐᵃᵏᵉ ᵗᶦⁿʸ",
                      "input_message_content": {
-                         "message_text": "ᵗᵉˣᵗ ᵗᵒ ᵐᵃᵏᵉ ᵗᶦⁿʸ"}}]}
+                         "message_text": "ᵗᵉˣᵗ ᵗᵒ ᵐᵃᵏᵉ ᵗᶦⁿʸ"}}],
+        "cache_time": 300,
+        "is_personal": False}
 
     correct_params_for_received = {
         Params.VERSION.value: 1,
+        Params.SAMPLE_WEIGHT.value: 1,
         Params.TOKEN_ID.value: ANALYTICS_TOKEN,
         Params.TYPE.value: Params.EVENT.value,
         Params.EVENT_ACTION.value: analytics.Event.Action.PREVIEW.value,
@@ -362,10 +376,13 @@ class TestUnsuccessfulReplyToInlineQuery(BaseTest):
                      "title": "Choose this to send your tiny text!",
                      "description": "ᵗᵉˣᵗ ᵗᵒ ᵐᵃᵏᵉ ᵗᶦⁿʸ",
                      "input_message_content": {
-                         "message_text": "ᵗᵉˣᵗ ᵗᵒ ᵐᵃᵏᵉ ᵗᶦⁿʸ"}}]}
+                         "message_text": "ᵗᵉˣᵗ ᵗᵒ ᵐᵃᵏᵉ ᵗᶦⁿʸ"}}],
+        "cache_time": 300,
+        "is_personal": False}
 
     correct_params_for_sent = {
         Params.VERSION.value: 1,
+        Params.SAMPLE_WEIGHT.value: 1,
         Params.TOKEN_ID.value: ANALYTICS_TOKEN,
         Params.TYPE.value: Params.EVENT.value,
         Params.EVENT_ACTION.value: analytics.Event.Action.FAILED.value,
@@ -388,6 +405,7 @@ class TestChosenInlineQuery(BaseTest):
 
     correct_params_for_received = {
         Params.VERSION.value: 1,
+        Params.SAMPLE_WEIGHT.value: 1,
         Params.TOKEN_ID.value: ANALYTICS_TOKEN,
         Params.TYPE.value: Params.EVENT.value,
         Params.EVENT_ACTION.value: analytics.Event.Action.SENT.value,
@@ -409,6 +427,7 @@ class TestDuplicates(object):
 
     correct_params_for_duplicate = {
         Params.VERSION.value: 1,
+        Params.SAMPLE_WEIGHT.value: 1,
         Params.TOKEN_ID.value: ANALYTICS_TOKEN,
         Params.TYPE.value: Params.EVENT.value,
         Params.USER_ID.value:
@@ -424,7 +443,7 @@ class TestDuplicates(object):
         mock_telegram()
         mock_analytics()
 
-        application.processed_updates.clear()
+        application.default_bot.processed_updates.clear()
 
         app.post("/" + TELEGRAM_TOKEN,
                  data=json.dumps(self.update),
@@ -453,4 +472,412 @@ class TestDuplicates(object):
         assert log_received_params == self.correct_params_for_duplicate
 
     def test_tracker(self):
-        assert len(application.processed_updates) == 1
+        assert len(application.default_bot.processed_updates) == 1
+
+
+class TestMalformedUpdate(object):
+    @responses.activate
+    def test_rejected(self, app):
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data="{\"update_id\": 1, \"message\": ",
+                            content_type="application/json")
+        assert response.status_code == 400
+        assert len(responses.calls) == 0
+
+    # Bodies that pass the prefilter and decode, but are not an update object.
+    @responses.activate
+    @pytest.mark.parametrize("body", [
+        {Update.Type.MESSAGE.value: {Update.Field.UPDATE_ID.value: 1}},
+        [Update.Field.UPDATE_ID.value, Update.Type.MESSAGE.value]])
+    def test_not_an_update(self, app, body):
+        malformed = metrics.counters["updates.rejected.malformed"]
+
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data=json.dumps(body),
+                            content_type="application/json")
+        assert response.status_code == 400
+        assert len(responses.calls) == 0
+        assert metrics.counters["updates.rejected.malformed"] == malformed + 1
+
+
+# Requests that cannot hold a supported update are rejected before decoding,
+# and never cost an outgoing request.
+class TestPrefilter(object):
+    @responses.activate
+    def test_too_large(self, app):
+        update = copy.copy(TestMessage.update)
+        update["padding"] = "x" * application.MAX_UPDATE_SIZE
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data=json.dumps(update),
+                            content_type="application/json")
+        assert response.status_code == 413
+        assert len(responses.calls) == 0
+
+    @responses.activate
+    def test_wrong_content_type(self, app):
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data=json.dumps(TestMessage.update),
+                            content_type="text/plain")
+        assert response.status_code == 415
+        assert len(responses.calls) == 0
+
+    @responses.activate
+    def test_unsupported_counted(self, app):
+        update = {Update.Field.UPDATE_ID.value: 10,
+                  Update.Type.CALLBACK_QUERY.value: {
+                      Update.Field.ID.value: "1"}}
+        unsupported = metrics.counters["updates.unsupported"]
+
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data=json.dumps(update),
+                            content_type="application/json")
+        assert response.status_code == 200
+        assert len(responses.calls) == 0
+        assert metrics.counters["updates.unsupported"] == unsupported + 1
+
+
+# Analytics are non-essential, so only the reply should be sent when the
+# update's deadline is already too near.
+class TestAnalyticsSkippedNearDeadline(object):
+    update = copy.copy(TestMessage.update)
+    update[Update.Field.UPDATE_ID.value] = 6
+
+    @responses.activate
+    def test_only_reply_sent(self, app, monkeypatch):
+        monkeypatch.setattr(deadline, "NON_ESSENTIAL_MINIMUM",
+                            deadline.UPDATE_BUDGET + 1)
+        mock_telegram()
+        mock_analytics()
+
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data=json.dumps(self.update),
+                            content_type="application/json")
+        assert response.status_code == 200
+        assert len(responses.calls) == 1
+        assert telegram.api_send_message in responses.calls[0].request.url
+
+
+# With a worker pool, the webhook returns before the reply is sent.
+class TestQueuedUpdate(object):
+    update = copy.copy(TestMessage.update)
+    update[Update.Field.UPDATE_ID.value] = 7
+
+    @responses.activate
+    def test_handled_by_worker(self, app, monkeypatch):
+        pool = workers.WorkerPool("workers.test", workers=1, queue_size=1)
+        pool.start()
+        monkeypatch.setattr(application, "pool", pool)
+        mock_telegram()
+        mock_analytics()
+
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data=json.dumps(self.update),
+                            content_type="application/json")
+        assert response.status_code == 200
+        assert application.default_bot.queued_updates.contains_value(7)
+
+        pool.stop()
+        assert len(responses.calls) == TestMessage.correct_number_of_calls
+        assert application.default_bot.processed_updates.contains_value(7)
+
+    def test_rejected_when_full(self, app, monkeypatch):
+        pool = workers.WorkerPool("workers.test", workers=1, queue_size=1,
+                                  queue_timeout=0)
+        pool.submit(0, lambda: None)
+        monkeypatch.setattr(application, "pool", pool)
+        update = copy.copy(self.update)
+        update[Update.Field.UPDATE_ID.value] = 71
+
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data=json.dumps(update),
+                            content_type="application/json")
+        assert response.status_code == 503
+        assert not application.default_bot.queued_updates.contains_value(71)
+
+    # The update was acknowledged already, so waiting behind a slow job
+    # must not use up the budget for its reply.
+    @responses.activate
+    def test_waiting_does_not_use_budget(self, app, monkeypatch):
+        monkeypatch.setattr(deadline, "UPDATE_BUDGET", 0.5)
+        monkeypatch.setattr(deadline, "NON_ESSENTIAL_MINIMUM", 0)
+        pool = workers.WorkerPool("workers.test", workers=1, queue_size=2)
+        pool.start()
+        monkeypatch.setattr(application, "pool", pool)
+        mock_telegram()
+        mock_analytics()
+        release = threading.Event()
+        pool.submit(0, release.wait)
+        update = copy.copy(self.update)
+        update[Update.Field.UPDATE_ID.value] = 72
+
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data=json.dumps(update),
+                            content_type="application/json")
+        assert response.status_code == 200
+        time.sleep(0.7)
+        release.set()
+        pool.stop()
+
+        assert len(responses.calls) == TestMessage.correct_number_of_calls
+        assert application.default_bot.processed_updates.contains_value(72)
+
+    # Spans recorded by the worker belong to the webhook's trace.
+    @responses.activate
+    def test_worker_continues_trace(self, app, monkeypatch):
+        monkeypatch.setattr(tracing, "SAMPLE_RATE", 1)
+        spans = []
+        monkeypatch.setattr(tracing, "record",
+                            lambda trace_id, span_id, parent_id, name, *rest:
+                            spans.append((trace_id, name)))
+        pool = workers.WorkerPool("workers.test", workers=1, queue_size=1)
+        pool.start()
+        monkeypatch.setattr(application, "pool", pool)
+        mock_telegram()
+        mock_analytics()
+        update = copy.copy(self.update)
+        update[Update.Field.UPDATE_ID.value] = 73
+
+        app.post("/" + TELEGRAM_TOKEN,
+                 data=json.dumps(update),
+                 content_type="application/json")
+        pool.stop()
+
+        names = [name for _, name in spans]
+        assert "route_update" in names
+        assert "handle_update" in names
+        assert "run_queued" not in names
+        assert "telegram" in names
+        assert len(set(trace_id for trace_id, _ in spans)) == 1
+
+
+class TestWorkerPool(object):
+    def test_same_key_handled_in_order(self):
+        pool = workers.WorkerPool("workers.test", workers=4, queue_size=100)
+        handled = []
+        pool.start()
+        for number in range(50):
+            pool.submit(number % 2, handled.append, number)
+        pool.stop()
+
+        evens = [number for number in handled if number % 2 == 0]
+        odds = [number for number in handled if number % 2 == 1]
+        assert evens == list(range(0, 50, 2))
+        assert odds == list(range(1, 50, 2))
+
+    def test_drain_counts_running_and_queued_jobs(self):
+        pool = workers.WorkerPool("workers.test", workers=1, queue_size=2)
+        started = threading.Event()
+        pool.start()
+        pool.submit(0, lambda: started.set() or time.sleep(0.2))
+        pool.submit(0, time.sleep, 0)
+        started.wait(1)
+
+        assert pool.drain(timeout=2) == (2, 0, 0)
+
+
+# At full capacity, inline queries are still answered, but without
+# analytics, while less important updates are shed.
+class TestAdmissionAtCapacity(object):
+    @responses.activate
+    def test_inline_query_degraded(self, app, monkeypatch):
+        monkeypatch.setattr(application.controller, "capacity", 1)
+        mock_telegram()
+        mock_analytics()
+        update = copy.copy(TestInlineQuery.update)
+        update[Update.Field.UPDATE_ID.value] = 8
+
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data=json.dumps(update),
+                            content_type="application/json")
+        assert response.status_code == 200
+        assert len(responses.calls) == 1
+        assert telegram.api_answer_inline_query in \
+            responses.calls[0].request.url
+
+    @responses.activate
+    def test_message_shed(self, app, monkeypatch):
+        monkeypatch.setattr(application.controller, "capacity", 1)
+        mock_telegram()
+        mock_analytics()
+        update = copy.copy(TestMessage.update)
+        update[Update.Field.UPDATE_ID.value] = 81
+        shed = metrics.counters["admission.shed.message"]
+
+        response = app.post("/" + TELEGRAM_TOKEN,
+                            data=json.dumps(update),
+                            content_type="application/json")
+        assert response.status_code == 200
+        assert len(responses.calls) == 0
+        assert metrics.counters["admission.shed.message"] == shed + 1
+
+
+class TestAdminEndpoints(object):
+    def test_hidden_without_token(self, app):
+        response = app.post("/" + TELEGRAM_TOKEN + "/admin/memory")
+        assert response.status_code == 404
+
+    def test_profile_samples_other_threads(self, app, monkeypatch):
+        monkeypatch.setattr(profiling, "ADMIN_TOKEN", "admin")
+        headers = {"X-Admin-Token": "admin"}
+        url = "/" + TELEGRAM_TOKEN + "/admin/profile"
+
+        def busy_loop(stop):
+            while not stop.is_set():
+                sum(range(100))
+
+        stop = threading.Event()
+        busy = threading.Thread(target=busy_loop, args=(stop,))
+        busy.start()
+        try:
+            response = app.post(url + "?seconds=5", headers=headers)
+            assert response.status_code == 202
+            time.sleep(0.2)
+            response = app.get(url, headers=headers)
+        finally:
+            stop.set()
+            busy.join()
+
+        assert response.status_code == 200
+        assert "busy_loop" in response.data.decode(UTF8)
+
+
+class TestSecondBot(object):
+    update = copy.copy(TestMessage.update)
+    update[Update.Field.UPDATE_ID.value] = 9
+
+    @responses.activate
+    def test_uses_own_token_and_tracker(self, app, monkeypatch):
+        second_bot = bot.Bot("second", "second-token", "UA-2")
+        monkeypatch.setitem(application.bots, second_bot.token, second_bot)
+        responses.add(method=responses.POST,
+                      url=second_bot.api_send_message,
+                      status=200,
+                      json={"ok": True})
+        mock_analytics()
+
+        response = app.post("/" + second_bot.token,
+                            data=json.dumps(self.update),
+                            content_type="application/json")
+        assert response.status_code == 200
+        assert len(responses.calls) == TestMessage.correct_number_of_calls
+        assert responses.calls[0].request.url == second_bot.api_send_message
+        params = get_params(responses.calls[1].request)
+        assert params[Params.TOKEN_ID.value] == "UA-2"
+        assert second_bot.processed_updates.contains_value(9)
+        assert not application.default_bot.processed_updates.contains_value(9)
+
+    def test_unknown_token(self, app):
+        response = app.post("/unknown-token",
+                            data=json.dumps(self.update),
+                            content_type="application/json")
+        assert response.status_code == 404
+
+
+class TestShutdown(object):
+    @responses.activate
+    def test_refuses_updates_and_saves_trackers(self, app, monkeypatch,
+                                                 tmpdir):
+        location = str(tmpdir.join("state.json"))
+        monkeypatch.setattr(bot, "STATE_LOCATION", location)
+        application.default_bot.processed_updates.add(12)
+
+        try:
+            report = shutdown.shut_down(application.drain, grace_period=1)
+            response = app.post("/" + TELEGRAM_TOKEN,
+                                data=json.dumps(TestMessage.update),
+                                content_type="application/json")
+        finally:
+            shutdown._stopping.clear()
+
+        assert response.status_code == 503
+        assert len(responses.calls) == 0
+        assert report["requests abandoned"] == 0
+        assert report["trackers saved"] == 1
+
+        restored_bot = bot.Bot(application.default_bot.name, "token", "UA-3")
+        bot.load_state({restored_bot.token: restored_bot}, location)
+        assert restored_bot.processed_updates.contains_value(12)
+
+    # The signal handler interrupts the thread serving a request, which must
+    # be left to finish that request while the shutdown waits for it.
+    @responses.activate
+    def test_drains_interrupted_request(self, app, monkeypatch, tmpdir):
+        monkeypatch.setattr(bot, "STATE_LOCATION",
+                            str(tmpdir.join("state.json")))
+        reports = []
+        exits = []
+
+        def drain(deadline):
+            reports.append(application.drain(deadline))
+            return reports[-1]
+
+        @application.controller.counted
+        def interrupted_request():
+            thread = shutdown.shut_down_in_background(drain, grace_period=5,
+                                                      exit=exits.append)
+            time.sleep(0.1)
+            return thread
+
+        try:
+            thread = interrupted_request()
+            response = app.post("/" + TELEGRAM_TOKEN,
+                                data=json.dumps(TestMessage.update),
+                                content_type="application/json")
+            thread.join(5)
+        finally:
+            shutdown._stopping.clear()
+
+        assert response.status_code == 503
+        assert exits == [0]
+        assert reports[0]["requests abandoned"] == 0
+        assert reports[0]["trackers saved"] == 1
+
+
+class TestAnalyticsSampling(object):
+    @responses.activate
+    def test_sampled_hit_is_weighted(self, monkeypatch):
+        monkeypatch.setattr(analytics, "sample_rates",
+                            analytics.parse_sample_rates("User.Preview=0.05"))
+        monkeypatch.setattr(analytics.random, "random", lambda: 0.01)
+        mock_analytics()
+
+        assert analytics.update(2,
+                                analytics.Event.Category.USER,
+                                analytics.Event.Action.PREVIEW)
+        assert len(responses.calls) == 2
+        params = get_params(responses.calls[1].request)
+        assert params[Params.SAMPLE_WEIGHT.value] == 20
+
+    @responses.activate
+    def test_unsampled_hit_is_not_sent(self, monkeypatch):
+        monkeypatch.setattr(analytics, "sample_rates",
+                            analytics.parse_sample_rates("User.Preview=0.05"))
+        monkeypatch.setattr(analytics.random, "random", lambda: 0.5)
+        mock_analytics()
+
+        assert analytics.update(2,
+                                analytics.Event.Category.USER,
+                                analytics.Event.Action.PREVIEW)
+        assert len(responses.calls) == 0
+
+    # A hit stands for a whole number of events, so a rate such as 0.8 could
+    # only be honoured by sending at a different rate.
+    def test_rate_not_inverse_of_whole_number_rejected(self):
+        with pytest.raises(ValueError):
+            analytics.parse_sample_rates("User.Preview=0.8")
+
+    def test_unsampled_duplicate_is_not_dispatched(self, monkeypatch):
+        sample_rates = analytics.parse_sample_rates("User.Duplicate=0.05")
+        monkeypatch.setattr(analytics, "sample_rates", sample_rates)
+        monkeypatch.setattr(analytics.random, "random", lambda: 0.5)
+        dispatched = []
+        monkeypatch.setattr(application, "dispatch",
+                            lambda *args, **kwargs: dispatched.append(args))
+
+        application.update_analytics_only(application.default_bot,
+                                          2,
+                                          analytics.Event.Category.USER,
+                                          analytics.Event.Action.DUPLICATE,
+                                          5,
+                                          deadline.Deadline())
+        assert dispatched == []
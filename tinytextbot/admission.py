@@ -0,0 +1,78 @@
+import functools
+import logging
+import os
+import threading
+from enum import Enum, IntEnum
+
+from tinytextbot import metrics
+from tinytextbot.telegram import Update
+
+# Number of updates that may be in flight or queued before
+# the least important ones are shed.
+CAPACITY = int(os.environ.get("ADMISSION_CAPACITY", "32"))
+
+
+class Priority(IntEnum):
+    ANALYTICS = 0
+    CHOSEN_INLINE_RESULT = 1
+    MESSAGE = 2
+    INLINE_QUERY = 3
+
+
+class Admission(Enum):
+    ACCEPT = "accept"
+    # Handle the update, but skip non-essential work such as analytics.
+    DEGRADE = "degrade"
+    SHED = "shed"
+
+
+priorities = {Update.Type.INLINE_QUERY: Priority.INLINE_QUERY,
+              Update.Type.MESSAGE: Priority.MESSAGE,
+              Update.Type.CHOSEN_INLINE_RESULT: Priority.CHOSEN_INLINE_RESULT}
+
+# Fraction of the capacity above which each priority is shed.
+# Above the lowest threshold, everything else is degraded.
+thresholds = {Priority.ANALYTICS: 0.5,
+              Priority.CHOSEN_INLINE_RESULT: 0.7,
+              Priority.MESSAGE: 0.9,
+              Priority.INLINE_QUERY: 1.0}
+
+
+class AdmissionController(object):
+    def __init__(self, name, capacity=CAPACITY):
+        super().__init__()
+        self.name = name
+        self.capacity = capacity
+        self.in_flight = 0
+        # Reentrant, so that a signal handler reading the count cannot
+        # deadlock the thread it interrupted.
+        self.lock = threading.RLock()
+
+    # Counts calls to the decorated function as in flight while they run.
+    def counted(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.lock:
+                self.in_flight += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+        return wrapper
+
+    # Decides how to treat work of the given priority, given the number of
+    # updates in flight and backlog more that are waiting to be handled.
+    def decide(self, priority, backlog=0):
+        load = (self.in_flight + backlog) / self.capacity
+        name = priority.name.lower()
+
+        if load > thresholds[priority]:
+            logging.getLogger(self.name).info(
+                "Shedding " + name + " at load " + str(load) + ".")
+            metrics.increment(self.name + ".shed." + name)
+            return Admission.SHED
+        if load > thresholds[Priority.ANALYTICS]:
+            metrics.increment(self.name + ".degraded." + name)
+            return Admission.DEGRADE
+        return Admission.ACCEPT
@@ -1,9 +1,12 @@
 import logging
 import os
+import random
 from enum import Enum
 
 import requests
 
+from tinytextbot import codec, connections, metrics, tracing
+
 
 class Event(object):
     class Category(Enum):
@@ -32,6 +35,9 @@ class Event(object):
         TYPE = "t"
         USER_ID = "uid"
         EVENT = "event"
+        # Custom metric holding the number of events a hit stands for, which
+        # is 1 unless the event is sampled, so its sum counts every event.
+        SAMPLE_WEIGHT = "cm1"
 
 
 TOKEN = os.environ["ANALYTICS_TOKEN"]
@@ -43,27 +49,84 @@ base_payload = {Event.Params.VERSION.value: "1",
                 Event.Params.TYPE.value: "event"}
 
 
+# Parses rates such as "User.Preview=0.05,User.Duplicate=0.05" into
+# the fraction of hits to send for each (category, action).
+# Each hit stands for a whole number of events, so every rate must be 1/n for
+# some whole n. Raises ValueError otherwise, rather than send at another rate.
+def parse_sample_rates(setting):
+    rates = {}
+    for entry in setting.split(","):
+        if not entry.strip():
+            continue
+        name, rate = entry.split("=")
+        category, action = name.strip().split(".")
+        rate = float(rate)
+        if not 0 < rate <= 1 or abs(rate * round(1 / rate) - 1) > 0.001:
+            raise ValueError("Sample rate " + str(rate) + " for " +
+                             name.strip() + " is not 1/n for a whole n.")
+        rates[(Event.Category(category), Event.Action(action))] = rate
+    return rates
+
+
+# Events that are not listed are always sent.
+sample_rates = parse_sample_rates(os.environ.get("ANALYTICS_SAMPLE_RATES",
+                                                 ""))
+
+
+# Decides whether to send an event, given its sample rate.
+# Returns the number of events the hit stands for, or None if the event
+# should not be sent.
+def sample(event_category, event_action):
+    rate = sample_rates.get((event_category, event_action), 1)
+    weight = round(1 / rate)
+    if weight > 1 and random.random() * weight >= 1:
+        metrics.increment("analytics.sampled_out." + event_category.value +
+                          "." + event_action.value)
+        return None
+    return weight
+
+
 # Sends a payload containing base_payload and params to Google Analytics.
 # If the hit is valid as verified by sending it to analytics_debug,
 # then the hit will be sent to analytics_real.
-def update(user_id, event_category, event_action, event_label=None, timeout=7):
+# If a deadline is given, the hit is skipped when too little of its budget
+# remains, and each call is limited to the remaining budget.
+# If a token is given, it replaces TOKEN as the property to update.
+# Events with a sample rate are only sent with that probability, weighted by
+# the number of events each hit stands for; unsent events count as updated.
+# If the event was already sampled, its weight is given instead.
+def update(user_id, event_category, event_action, event_label=None, timeout=7,
+           deadline=None, token=None, weight=None):
     logger = logging.getLogger("Analytics")
-    params = build_params(user_id, event_category, event_action, event_label)
-    valid = validate_hit(params, timeout)
+    if weight is None:
+        weight = sample(event_category, event_action)
+        if weight is None:
+            return True
+
+    if deadline and not deadline.allows_non_essential():
+        logger.info("Skipped " + event_category.value + " " +
+                    event_action.value + " as the deadline is near.")
+        metrics.increment("analytics.skipped_near_deadline")
+        return False
+
+    params = build_params(user_id, event_category, event_action, event_label,
+                          token)
+    params[Event.Params.SAMPLE_WEIGHT.value] = weight
+    valid = validate_hit(params, timeout, deadline)
     if valid:
-        response = send(analytics_real, params, timeout)
+        response = send(analytics_real, params, timeout, deadline)
         if response:
             logger.info("Successfully updated with " + str(params))
     return valid
 
 
 # Sends params to analytics_debug to check if the hit is valid.
-def validate_hit(params, timeout):
+def validate_hit(params, timeout, deadline=None):
     logger = logging.getLogger("Analytics")
-    response = send(analytics_debug, params, timeout=timeout)
+    response = send(analytics_debug, params, timeout, deadline)
     valid = False
     if response:
-        result = response.json()["hitParsingResult"][0]
+        result = codec.loads(response.content)["hitParsingResult"][0]
         valid = result["valid"]
         if not valid:
             logger.info("Invalid update occurred.")
@@ -73,13 +136,21 @@ def validate_hit(params, timeout):
 
 # Sends params to destination via url-encoding.
 # Catches common connection errors.
-def send(destination, params, timeout):
+def send(destination, params, timeout, deadline=None):
     response = None
     logger = logging.getLogger("connection.analytics")
+    if deadline:
+        timeout = deadline.timeout(timeout)
+        if timeout <= 0:
+            logger.info("Deadline exceeded before sending.")
+            metrics.increment("analytics.deadline_exceeded")
+            return response
+
     try:
-        response = requests.post(destination,
-                                 params=params,
-                                 timeout=timeout)
+        with tracing.span("analytics", url=destination):
+            response = connections.session.post(destination,
+                                                params=params,
+                                                timeout=timeout)
     except requests.Timeout:
         logger.info("Timed out after " + str(timeout) + " seconds. ")
     except requests.ConnectionError:
@@ -90,7 +161,8 @@ def send(destination, params, timeout):
     return response
 
 
-def build_params(user_id, event_category, event_action, event_label):
+def build_params(user_id, event_category, event_action, event_label,
+                 token=None):
     params = {"uid": user_id,
               "ec": event_category.value,
               "ea": event_action.value}
@@ -99,4 +171,6 @@ def build_params(user_id, event_category, event_action, event_label):
         params.update(el=event_label)
 
     params.update(base_payload)
+    if token is not None:
+        params[Event.Params.TOKEN_ID.value] = token
     return params
@@ -1,9 +1,14 @@
 import flask
+import functools
 import logging
 import os
-from tinytextbot.sorted_dict_with_max_size import SortedDictWithMaxSize
+import time
+from tinytextbot.admission import Admission, AdmissionController, Priority, \
+    priorities
+from tinytextbot.deadline import Deadline
 
-from tinytextbot import tiny, analytics, telegram
+from tinytextbot import tiny, analytics, telegram, codec, tracing, workers, \
+    metrics, profiling, bot, shutdown
 
 logging.basicConfig(filename=os.environ["LOG_LOCATION"],
                     level=logging.DEBUG,
@@ -20,20 +25,88 @@ INSTRUCTIONS = "To use this bot, enter \"@tinytextbot\" followed by " \
                "your desired message in the chat you want to send " \
                "tiny text to. Tap on the message preview to select and " \
                "send the converted message."
-
-# Track the latest unique updates to prevent spamming users with multiple
-# responses to the same update.
-processed_updates = SortedDictWithMaxSize("tracker.processed_updates")
-ignored_updates = SortedDictWithMaxSize("tracker.ignored_updates")
-
-
-# Sends a Telegram message
-def send_message(chat_id, message_text, error_message):
-    message = {"chat_id": chat_id, "text": message_text}
-    response = telegram.post(telegram.api_send_message,
+# Encoded once, as every instructions and greeting message is identical.
+INSTRUCTIONS_JSON = codec.precompute(INSTRUCTIONS)
+GREETING_JSON = codec.precompute("\n".join([HELLO, INSTRUCTIONS]))
+# A query always converts to the same text, so Telegram may cache answers for
+# INLINE_CACHE_TIME seconds and share them between users.
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "300"))
+MAX_UPDATE_SIZE = int(os.environ.get("MAX_UPDATE_SIZE", "65536"))  # in bytes
+
+# Every bot served by this process, keyed by token.
+bots = bot.load()
+bot.load_state(bots)
+default_bot = bots[telegram.TOKEN]
+
+# If there are workers, the webhook only queues updates for them.
+pool = None
+if workers.WORKERS:
+    pool = workers.WorkerPool("workers.updates")
+    pool.start()
+
+
+# Sheds the least important updates first when too many are in flight.
+controller = AdmissionController("admission")
+
+
+# Returns the number of updates waiting for a worker.
+def backlog():
+    return pool.depth() if pool else 0
+
+
+# Calls function with args, kwargs and deadline, on a worker if there is a
+# pool. Functions dispatched with the same key, usually the user id, are
+# called in the order they were dispatched.
+def dispatch(key, function, *args, deadline=None, **kwargs):
+    if pool:
+        return pool.submit(key, queued(function), deadline, *args, **kwargs)
+    function(*args, deadline=deadline, **kwargs)
+    return True
+
+
+# Wraps function to be called from the queue with its deadline restarted.
+# The update was acknowledged before it was queued, so time spent waiting for
+# a worker should not use up the budget for its outbound calls.
+# The wrapper keeps the name of function, which names the worker's span.
+def queued(function):
+    @functools.wraps(function)
+    def run_queued(deadline, *args, **kwargs):
+        if deadline:
+            deadline.restart()
+        return function(*args, deadline=deadline, **kwargs)
+    return run_queued
+
+
+# Updates analytics for an update that is otherwise ignored,
+# unless the event is sampled out or analytics-only work is being shed.
+def update_analytics_only(current_bot, user_id, event_category, event_action,
+                          event_label, deadline):
+    weight = analytics.sample(event_category, event_action)
+    if weight is None:
+        return
+    if controller.decide(Priority.ANALYTICS, backlog()) is Admission.SHED:
+        return
+    dispatch(user_id,
+             analytics.update,
+             user_id,
+             event_category,
+             event_action,
+             event_label=event_label,
+             deadline=deadline,
+             token=current_bot.analytics_token,
+             weight=weight)
+
+
+# Sends a Telegram message.
+# message_text may be a str, or a codec.Encoded for precomputed messages.
+def send_message(current_bot, chat_id, message_text, error_message,
+                 deadline=None):
+    message = codec.encode_object({"chat_id": chat_id, "text": message_text})
+    response = telegram.post(current_bot.api_send_message,
                              message,
                              error_message,
-                             connection_timeout=CONNECTION_TIMEOUT)
+                             connection_timeout=CONNECTION_TIMEOUT,
+                             deadline=deadline)
     return telegram.check_response(response)
 
 
@@ -41,7 +114,7 @@ def send_message(chat_id, message_text, error_message):
 # If the received message is "/start", which is automatically sent when a user
 # begins interacting with the bot, the bot will reply with a standard greeting.
 # Else, the bot will reply with usage instructions.
-def message_to_bot_handler(update, update_id):
+def message_to_bot_handler(current_bot, update, update_id, deadline=None):
     fields = telegram.Update.Field
     user_id = telegram.get_user_id(update, telegram.Update.Type.MESSAGE)
     message = update[telegram.Update.Type.MESSAGE.value]
@@ -57,12 +130,15 @@ def message_to_bot_handler(update, update_id):
                                             ": \"" + message_text + "\"")
 
     if message_text == telegram.Update.Field.START.value:
-        return greet_new_user(update_id, chat_id, user_id, message_id)
+        return greet_new_user(current_bot, update_id, chat_id, user_id,
+                              message_id, deadline)
 
     response_success, response_text = send_message(
+        current_bot,
         chat_id,
-        INSTRUCTIONS,
-        "Failed to send instructions to " + str(user_id) + ".")
+        INSTRUCTIONS_JSON,
+        "Failed to send instructions to " + str(user_id) + ".",
+        deadline)
 
     logging.getLogger("bot.response.message").debug(
         "To " + str(message_id) +
@@ -72,33 +148,40 @@ def message_to_bot_handler(update, update_id):
         response_text)
 
     if response_success:
-        processed_updates.add(update_id)
+        current_bot.processed_updates.add(update_id)
 
         analytics.update(user_id,
                          analytics.Event.Category.USER,
                          analytics.Event.Action.MESSAGE,
-                         event_label=message_text)
+                         event_label=message_text,
+                         deadline=deadline,
+                         token=current_bot.analytics_token)
 
         analytics.update(user_id,
                          analytics.Event.Category.BOT,
                          analytics.Event.Action.INSTRUCTIONS,
-                         event_label=update_id)
+                         event_label=update_id,
+                         deadline=deadline,
+                         token=current_bot.analytics_token)
     else:
         analytics.update(user_id,
                          analytics.Event.Category.BOT,
                          analytics.Event.Action.FAILED,
-                         event_label=update_id)
+                         event_label=update_id,
+                         deadline=deadline,
+                         token=current_bot.analytics_token)
     return ""
 
 
 # Sends a greeting
-def greet_new_user(update_id, chat_id, user_id, message_id):
-    greeting = "\n".join([HELLO, INSTRUCTIONS])
-
+def greet_new_user(current_bot, update_id, chat_id, user_id, message_id,
+                   deadline=None):
     response_success, response_text = send_message(
+        current_bot,
         chat_id,
-        greeting,
-        "Failed to send greeting to " + str(user_id) + ".")
+        GREETING_JSON,
+        "Failed to send greeting to " + str(user_id) + ".",
+        deadline)
 
     logging.getLogger("bot.response.message").debug(
         "To " + str(message_id) +
@@ -108,43 +191,55 @@ def greet_new_user(update_id, chat_id, user_id, message_id):
         ". " + response_text)
 
     if response_success:
-        processed_updates.add(update_id)
+        current_bot.processed_updates.add(update_id)
         analytics.update(user_id,
                          analytics.Event.Category.USER,
                          analytics.Event.Action.START,
-                         event_label=chat_id)
+                         event_label=chat_id,
+                         deadline=deadline,
+                         token=current_bot.analytics_token)
         analytics.update(user_id,
                          analytics.Event.Category.BOT,
                          analytics.Event.Action.GREETINGS,
-                         event_label=update_id)
+                         event_label=update_id,
+                         deadline=deadline,
+                         token=current_bot.analytics_token)
     else:
         analytics.update(user_id,
                          analytics.Event.Category.BOT,
                          analytics.Event.Action.FAILED,
-                         event_label=update_id)
+                         event_label=update_id,
+                         deadline=deadline,
+                         token=current_bot.analytics_token)
 
     return ""
 
 
 # Unwraps a query and responds with the query in tiny text.
-def inline_query_handler(update, update_id):
+def inline_query_handler(current_bot, update, update_id, deadline=None):
     fields = telegram.Update.Field
     inline_query = update[telegram.Update.Type.INLINE_QUERY.value]
     query = inline_query[fields.QUERY.value]
     if not query:
-        ignored_updates.add(update_id)
+        current_bot.ignored_updates.add(update_id)
         return ""
 
     user_id = telegram.get_user_id(update, telegram.Update.Type.INLINE_QUERY)
     query_id = inline_query[fields.ID.value]
-    result = telegram.Result(tiny.convert_string(query))
-    answer = {"inline_query_id": query_id, "results": [result.__dict__]}
+    with tracing.span("convert"):
+        result = telegram.Result(tiny.convert_string(query))
+    answer = codec.encode_object(
+        {"inline_query_id": query_id,
+         "results": codec.Encoded(codec.encode_array([result.encode()])),
+         "cache_time": INLINE_CACHE_TIME,
+         "is_personal": False})
 
     response = telegram.post(
-        telegram.api_answer_inline_query,
+        current_bot.api_answer_inline_query,
         answer,
         "Failed to answer inline query id " + str(query_id) + ".",
-        connection_timeout=CONNECTION_TIMEOUT)
+        connection_timeout=CONNECTION_TIMEOUT,
+        deadline=deadline)
     response_success, response_text = telegram.check_response(response)
 
     logging.getLogger("bot.response.inline_query").debug(
@@ -154,30 +249,36 @@ def inline_query_handler(update, update_id):
         response_text)
 
     if response_success:
-        processed_updates.add(update_id)
+        current_bot.processed_updates.add(update_id)
         analytics.update(user_id,
                          analytics.Event.Category.USER,
                          analytics.Event.Action.PREVIEW,
-                         event_label=update_id)
+                         event_label=update_id,
+                         deadline=deadline,
+                         token=current_bot.analytics_token)
     else:
         analytics.update(user_id,
                          analytics.Event.Category.BOT,
                          analytics.Event.Action.FAILED,
-                         event_label=update_id)
+                         event_label=update_id,
+                         deadline=deadline,
+                         token=current_bot.analytics_token)
 
     return ""
 
 
 # Updates analytics that a query result was chosen, and hence sent.
-def result_chosen_handler(update, update_id):
+def result_chosen_handler(current_bot, update, update_id, deadline=None):
     logging.getLogger("user.sent").info("Confirmation received.")
     user_id = telegram.get_user_id(update,
                                    telegram.Update.Type.CHOSEN_INLINE_RESULT)
     update_result = analytics.update(user_id,
                                      analytics.Event.Category.USER,
-                                     analytics.Event.Action.SENT)
+                                     analytics.Event.Action.SENT,
+                                     deadline=deadline,
+                                     token=current_bot.analytics_token)
     if update_result:
-        processed_updates.add(update_id)
+        current_bot.processed_updates.add(update_id)
 
     return ""
 
@@ -191,43 +292,211 @@ routes = {telegram.Update.Type.MESSAGE: message_to_bot_handler,
 # If the update is a previously processed update (i.e. Telegram repeated it),
 # or if the update is not a supported type as defined in routers,
 # ignore the update, and return a 200.
-@application.route("/" + telegram.TOKEN, methods=['POST'])
-def route_update():
+# All outbound calls made for the update share one deadline, so that the 200
+# is returned before Telegram gives up and redelivers the update.
+# If there are workers, the update is handled by them after the 200.
+# Under load, updates are shed or handled without analytics by priority.
+@application.route("/<token>", methods=['POST'])
+@tracing.traced
+@controller.counted
+def route_update(token):
     result = ""
-
-    update = flask.request.get_json()
+    deadline = Deadline()
+    current_bot = get_bot(token)
+
+    # Telegram redelivers the update once another instance is up.
+    if shutdown.stopping():
+        return result, 503
+
+    rejection = prefilter(flask.request)
+    if rejection:
+        return rejection
+
+    try:
+        with tracing.span("decode"):
+            update = codec.loads(flask.request.get_data())
+    except ValueError:
+        update = None
+    # The prefilter only finds "update_id" somewhere in the body, so the
+    # decoded body may still not be an update.
+    if not isinstance(update, dict) or \
+            telegram.Update.Field.UPDATE_ID.value not in update:
+        logging.getLogger("telegram.update").info("Malformed update received.")
+        metrics.increment("updates.rejected.malformed")
+        flask.abort(400)
 
     update_type = telegram.get_update_type(update)
     if not update_type:
         logger = logging.getLogger("telegram.update")
         logger.info("Unknown update type received. " + str(update))
-        analytics.update(0,
-                         analytics.Event.Category.TELEGRAM,
-                         analytics.Event.Action.UNKNOWN,
-                         event_label=str(update))
+        metrics.increment("updates.unknown")
         return result
 
+    metrics.increment("updates." + update_type.value)
     update_id = update[telegram.Update.Field.UPDATE_ID.value]
     if update_type not in routes:
         logging.getLogger("telegram.update").info("Ignoring update: " +
                                                   str(update))
-        ignored_updates.add(update_id)
-        analytics.update(0,
-                         analytics.Event.Category.TELEGRAM,
-                         analytics.Event.Action.UNSUPPORTED,
-                         event_label=update_type.value)
+        current_bot.ignored_updates.add(update_id)
         return result
 
+    tracing.tag("update_id", update_id)
     user_id = telegram.get_user_id(update, update_type)
-    if update_id in processed_updates.values() or \
-       update_id in ignored_updates.values():
+    with tracing.span("dedup"):
+        duplicate = current_bot.has_seen(update_id)
+    if duplicate:
         logger = logging.getLogger("tracker")
         logger.info("Ignoring update " + str(update_id) + ".")
-        analytics.update(user_id,
-                         analytics.Event.Category.USER,
-                         analytics.Event.Action.DUPLICATE,
-                         event_label=update_id)
+        update_analytics_only(current_bot,
+                              user_id,
+                              analytics.Event.Category.USER,
+                              analytics.Event.Action.DUPLICATE,
+                              update_id,
+                              deadline)
         return result
 
-    result = routes[update_type](update, update_id)
+    admission = controller.decide(priorities[update_type], backlog())
+    if admission is Admission.SHED:
+        current_bot.ignored_updates.add(update_id)
+        return result
+    if admission is Admission.DEGRADE:
+        deadline.skip_non_essential()
+
+    if not pool:
+        return handle_update(current_bot, update, update_type, update_id,
+                             deadline)
+
+    # Asks Telegram to redeliver the update later if the workers are
+    # too far behind to accept it now.
+    if not dispatch(user_id, handle_update, current_bot, update, update_type,
+                    update_id, deadline=deadline):
+        return result, 503
+    current_bot.queued_updates.add(update_id)
     return result
+
+
+# Keys of the update types that have handlers, as they appear in an update.
+routed_keys = [codec.dumps(update_type.value) for update_type in routes]
+
+
+# Cheaply rejects requests that cannot hold an update this bot handles,
+# before the body is decoded. Returns a response for a rejected request,
+# or None if the request should be decoded and routed.
+# Updates of types without handlers are counted instead of sent to analytics.
+def prefilter(request):
+    logger = logging.getLogger("telegram.update")
+    if request.content_length is None:
+        metrics.increment("updates.rejected.length_required")
+        return "", 411
+    if request.content_length > MAX_UPDATE_SIZE:
+        logger.info("Rejected update of " + str(request.content_length) +
+                    " bytes.")
+        metrics.increment("updates.rejected.too_large")
+        return "", 413
+    if request.mimetype != "application/json":
+        metrics.increment("updates.rejected.content_type")
+        return "", 415
+
+    data = request.get_data()
+    if b'"update_id"' not in data:
+        metrics.increment("updates.rejected.malformed")
+        return "", 400
+    if not any(key in data for key in routed_keys):
+        metrics.increment("updates.unsupported")
+        return "", 200
+    return None
+
+
+def handle_update(current_bot, update, update_type, update_id, deadline):
+    try:
+        with tracing.span("handler", update_type=update_type.value):
+            return routes[update_type](current_bot, update, update_id,
+                                       deadline)
+    finally:
+        profiling.update_handled()
+
+
+# Returns the bot whose webhook token is given, or responds with a 404.
+def get_bot(token):
+    current_bot = bots.get(token)
+    if not current_bot:
+        flask.abort(404)
+    return current_bot
+
+
+# Waits for the updates in flight and the queued jobs, including analytics,
+# to finish before the deadline, then saves the trackers.
+def drain(deadline):
+    report = {}
+    while controller.in_flight and not deadline.expired():
+        time.sleep(0.05)
+    report["requests abandoned"] = controller.in_flight
+
+    if pool:
+        finished, abandoned_queued, abandoned_running = \
+            pool.drain(deadline.remaining())
+        report["jobs drained"] = finished
+        report["queued jobs abandoned"] = abandoned_queued
+        report["running jobs abandoned"] = abandoned_running
+
+    report["trackers saved"] = int(bot.save_state(bots))
+    return report
+
+
+shutdown.install(drain)
+
+
+# Reports the counters, gauges and timings collected by this process.
+@application.route("/<token>/metrics", methods=['GET'])
+def report_metrics(token):
+    get_bot(token)
+    return flask.Response(codec.dumps(metrics.snapshot()),
+                          mimetype="application/json")
+
+
+def check_admin():
+    if not profiling.authorised(flask.request.headers.get("X-Admin-Token")):
+        flask.abort(404)
+
+
+# Starts sampling the CPU in the background for the given number of seconds
+# or updates, and returns at once.
+@application.route("/<token>/admin/profile", methods=['POST'])
+def start_profile(token):
+    get_bot(token)
+    check_admin()
+    try:
+        profiling.start(
+            seconds=flask.request.args.get("seconds", type=float),
+            updates=flask.request.args.get("updates", type=int))
+    except profiling.ProfilerBusy:
+        flask.abort(409)
+    return "", 202
+
+
+# Stops the profile if it is still running, and returns the collapsed stacks.
+@application.route("/<token>/admin/profile", methods=['GET'])
+def report_profile(token):
+    get_bot(token)
+    check_admin()
+    profile = profiling.collect()
+    if profile is None:
+        flask.abort(404)
+    return flask.Response(profile, mimetype="text/plain")
+
+
+# Reports memory growth since the previous request, along with the number of
+# updates each tracker holds.
+@application.route("/<token>/admin/memory", methods=['POST'])
+def report_memory(token):
+    get_bot(token)
+    check_admin()
+    sizes = {tracker.name: len(tracker)
+             for each_bot in bots.values()
+             for tracker in each_bot.trackers()}
+    sizes["metrics.counters"] = len(metrics.counters)
+    sizes["logging.loggers"] = len(logging.Logger.manager.loggerDict)
+    report = profiling.memory_report(
+        sizes,
+        stop=flask.request.args.get("stop", type=int) == 1)
+    return flask.Response(report, mimetype="text/plain")
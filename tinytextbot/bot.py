@@ -0,0 +1,105 @@
+import logging
+import os
+
+from tinytextbot import analytics, codec, telegram
+from tinytextbot.sorted_dict_with_max_size import SortedDictWithMaxSize
+
+# File in which the trackers are kept between runs, if set.
+STATE_LOCATION = os.environ.get("STATE_LOCATION")
+
+
+# A bot served by this process. Bots share the connections, converter and
+# workers, but each has its own token, webhook, trackers and analytics
+# property.
+class Bot(object):
+    def __init__(self, name, token, analytics_token):
+        super().__init__()
+        self.name = name
+        self.token = token
+        self.analytics_token = analytics_token
+        api_base = telegram.get_api_base(token)
+        self.api_send_message = api_base + "sendMessage"
+        self.api_answer_inline_query = api_base + "answerInlineQuery"
+
+        # Track the latest unique updates to prevent spamming users with
+        # multiple responses to the same update.
+        self.processed_updates = SortedDictWithMaxSize(
+            "tracker." + name + ".processed_updates")
+        self.ignored_updates = SortedDictWithMaxSize(
+            "tracker." + name + ".ignored_updates")
+        # Updates accepted by the webhook but not yet handled by a worker.
+        self.queued_updates = SortedDictWithMaxSize(
+            "tracker." + name + ".queued_updates")
+
+    def trackers(self):
+        return [self.processed_updates,
+                self.ignored_updates,
+                self.queued_updates]
+
+    # Trackers of updates that Telegram might redeliver after a restart.
+    # Queued updates are left out, as they were acknowledged already.
+    def persistent_trackers(self):
+        return {"processed_updates": self.processed_updates,
+                "ignored_updates": self.ignored_updates}
+
+    def has_seen(self, update_id):
+        return any(tracker.contains_value(update_id)
+                   for tracker in self.trackers())
+
+
+# Returns the bots to serve, keyed by their tokens.
+# The first bot uses TELEGRAM_TOKEN and ANALYTICS_TOKEN. BOTS may name more
+# bots, separated by commas, each of which uses TELEGRAM_TOKEN_<NAME> and
+# ANALYTICS_TOKEN_<NAME>.
+def load(environ=os.environ):
+    bots = [Bot("tinytextbot", telegram.TOKEN, analytics.TOKEN)]
+    for name in environ.get("BOTS", "").split(","):
+        name = name.strip()
+        if name:
+            bots.append(Bot(name,
+                            environ["TELEGRAM_TOKEN_" + name.upper()],
+                            environ["ANALYTICS_TOKEN_" + name.upper()]))
+    return {bot.token: bot for bot in bots}
+
+
+# Writes the persistent trackers of every bot to location.
+def save_state(bots, location=None):
+    location = location or STATE_LOCATION
+    if not location:
+        return False
+
+    state = {}
+    for each_bot in bots.values():
+        trackers = each_bot.persistent_trackers()
+        state[each_bot.name] = {}
+        for name, tracker in trackers.items():
+            with tracker.lock:
+                state[each_bot.name][name] = list(tracker.items())
+
+    with open(location, "wb") as state_file:
+        state_file.write(codec.dumps(state))
+    logging.getLogger("bot.state").info("Saved state to " + location + ".")
+    return True
+
+
+# Restores the persistent trackers of every bot from location, if it exists.
+def load_state(bots, location=None):
+    logger = logging.getLogger("bot.state")
+    location = location or STATE_LOCATION
+    if not location or not os.path.exists(location):
+        return False
+
+    try:
+        with open(location, "rb") as state_file:
+            state = codec.loads(state_file.read())
+    except ValueError:
+        logger.info("Could not decode state in " + location + ".")
+        return False
+
+    for each_bot in bots.values():
+        trackers = each_bot.persistent_trackers()
+        for name, items in state.get(each_bot.name, {}).items():
+            if name in trackers:
+                trackers[name].update(items)
+    logger.info("Loaded state from " + location + ".")
+    return True
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Encoded(object):
+    __slots__ = ("value",)
+
+    # Wraps bytes that are already valid JSON so that they can be embedded in
+    # a payload by encode_object without being serialised again.
+    def __init__(self, value):
+        self.value = value
+
+
+class Codec(object):
+    def __init__(self, name, loads, dumps):
+        super().__init__()
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+def stdlib_loads(data):
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8")
+    return json.loads(data)
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj,
+                      ensure_ascii=False,
+                      separators=(",", ":")).encode("utf-8")
+
+
+codecs = {"json": Codec("json", stdlib_loads, stdlib_dumps)}
+if orjson:
+    codecs["orjson"] = Codec("orjson", orjson.loads, orjson.dumps)
+
+_codec = None
+
+
+# Selects the codec used by loads and dumps.
+# If name is not given, JSON_CODEC is read from the environment, and failing
+# that, the fastest installed codec is used.
+def setup(name=None):
+    global _codec
+    logger = logging.getLogger("codec")
+
+    if not name:
+        name = os.environ.get("JSON_CODEC")
+    if name not in codecs:
+        if name:
+            logger.info("Codec " + name + " is not installed.")
+        name = "orjson" if "orjson" in codecs else "json"
+
+    _codec = codecs[name]
+    logger.info("Using codec " + name + ".")
+    return _codec
+
+
+# Decodes a JSON document given as bytes or str.
+# Raises ValueError if the document is malformed.
+def loads(data):
+    return _codec.loads(data)
+
+
+# Encodes obj as compact UTF-8 JSON bytes.
+def dumps(obj):
+    return _codec.dumps(obj)
+
+
+# Encodes value once so that it can be reused across payloads.
+def precompute(value):
+    return Encoded(dumps(value))
+
+
+# Encodes a flat dict as a JSON object, copying Encoded values verbatim.
+def encode_object(fields):
+    members = []
+    for key, value in fields.items():
+        if isinstance(value, Encoded):
+            encoded_value = value.value
+        else:
+            encoded_value = dumps(value)
+        members.append(dumps(key) + b":" + encoded_value)
+    return b"{" + b",".join(members) + b"}"
+
+
+# Encodes a list of Encoded values as a JSON array.
+def encode_array(values):
+    return b"[" + b",".join(value.value for value in values) + b"]"
+
+
+setup()
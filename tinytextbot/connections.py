@@ -0,0 +1,18 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Connections kept open to each host, shared by every bot and worker.
+POOL_SIZE = int(os.environ.get("CONNECTION_POOL_SIZE", "10"))
+
+
+def new_session(pool_size=POOL_SIZE):
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+session = new_session()
@@ -0,0 +1,42 @@
+import os
+import time
+
+# Total time, in seconds, that handling one update may take before Telegram
+# is likely to consider the webhook call failed and redeliver the update.
+UPDATE_BUDGET = float(os.environ.get("UPDATE_BUDGET", "10"))
+# Non-essential calls, such as analytics, are skipped once less than this
+# many seconds of the budget remain.
+NON_ESSENTIAL_MINIMUM = float(os.environ.get("NON_ESSENTIAL_MINIMUM", "1"))
+
+
+class Deadline(object):
+    def __init__(self, budget=None):
+        super().__init__()
+        if budget is None:
+            budget = UPDATE_BUDGET
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+        self.allow_non_essential = True
+
+    # Starts the budget again from now.
+    def restart(self):
+        self.expires_at = time.monotonic() + self.budget
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    # Returns the timeout for a call limited to at most limit seconds.
+    def timeout(self, limit):
+        return min(limit, self.remaining())
+
+    # Prevents any further non-essential work, regardless of the budget.
+    def skip_non_essential(self):
+        self.allow_non_essential = False
+
+    # Returns whether there is enough budget left for non-essential work.
+    def allows_non_essential(self):
+        return self.allow_non_essential and \
+            self.remaining() >= NON_ESSENTIAL_MINIMUM
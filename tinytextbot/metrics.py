@@ -0,0 +1,42 @@
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+counters = Counter()
+gauges = {}
+# Maps a timing's name to its count, total and maximum in seconds.
+timings = {}
+
+
+def increment(name, amount=1):
+    with _lock:
+        counters[name] += amount
+
+
+def set_gauge(name, value):
+    with _lock:
+        gauges[name] = value
+
+
+def observe(name, seconds):
+    with _lock:
+        count, total, maximum = timings.get(name, (0, 0.0, 0.0))
+        timings[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+
+def snapshot():
+    with _lock:
+        return {"counters": dict(counters),
+                "gauges": dict(gauges),
+                "timings": {name: {"count": count,
+                                   "mean": total / count,
+                                   "max": maximum}
+                            for name, (count, total, maximum)
+                            in timings.items()}}
+
+
+def clear():
+    with _lock:
+        counters.clear()
+        gauges.clear()
+        timings.clear()
@@ -0,0 +1,157 @@
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# Admin endpoints are disabled unless ADMIN_TOKEN is set.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+SAMPLE_INTERVAL = 0.005  # in seconds
+MAX_PROFILE_SECONDS = 60
+
+_lock = threading.Lock()
+_sampler = None
+_snapshot = None
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def authorised(token):
+    return bool(ADMIN_TOKEN) and token is not None and \
+        hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+# Periodically records the stack of every thread but its own, until it has
+# run for the given number of seconds, the given number of updates have been
+# handled, or it is stopped.
+# Nothing is sampled, and no thread runs, unless a profile was requested.
+class Sampler(object):
+    def __init__(self, seconds, updates=None, interval=SAMPLE_INTERVAL):
+        super().__init__()
+        self.seconds = seconds
+        self.interval = interval
+        self.remaining_updates = updates
+        self.stacks = Counter()
+        self.samples = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                                       name="profiling.sampler",
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        own_thread = threading.get_ident()
+        expires_at = time.monotonic() + self.seconds
+        while not self.done.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    self.stacks[collapse(frame)] += 1
+            self.samples += 1
+            if time.monotonic() >= expires_at:
+                self.done.set()
+
+    def running(self):
+        return not self.done.is_set()
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+
+    def update_handled(self):
+        if self.remaining_updates is None:
+            return
+        self.remaining_updates -= 1
+        if self.remaining_updates <= 0:
+            self.done.set()
+
+    # Returns the samples in the collapsed format read by flame graph tools,
+    # one "caller;callee count" line per distinct stack.
+    def dump(self):
+        lines = [stack + " " + str(count)
+                 for stack, count in self.stacks.most_common()]
+        return "\n".join(lines) + "\n"
+
+
+def collapse(frame):
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        functions.append(module + "." + code.co_name)
+        frame = frame.f_back
+    return ";".join(reversed(functions))
+
+
+# Starts sampling every thread in the background for the given number of
+# seconds, or until the given number of updates have been handled,
+# whichever is first. Only one profile can be taken at a time.
+def start(seconds=None, updates=None):
+    global _sampler
+    if seconds is None or seconds > MAX_PROFILE_SECONDS:
+        seconds = MAX_PROFILE_SECONDS
+
+    with _lock:
+        if _sampler is not None and _sampler.running():
+            raise ProfilerBusy()
+        _sampler = Sampler(seconds, updates)
+        _sampler.start()
+    logging.getLogger("profiling").info(
+        "Profiling for " + str(seconds) + " seconds or " + str(updates) +
+        " updates.")
+
+
+# Stops the current profile, if it is still running, and returns the
+# collapsed stacks of the latest profile, or None if there was none.
+def collect():
+    with _lock:
+        sampler = _sampler
+    if sampler is None:
+        return None
+
+    sampler.stop()
+    logging.getLogger("profiling").info(
+        "Took " + str(sampler.samples) + " samples.")
+    return sampler.dump()
+
+
+# Counts an update towards the current profile, if there is one.
+def update_handled():
+    sampler = _sampler
+    if sampler is not None:
+        sampler.update_handled()
+
+
+# Takes a tracemalloc snapshot and reports how allocations have grown since
+# the previous one, by line, along with the given sizes, such as the number
+# of updates held by each tracker.
+# Tracing memory starts with the first snapshot and continues until stop.
+def memory_report(sizes, limit=25, stop=False):
+    global _snapshot
+    lines = [name + ": " + str(size) for name, size in sorted(sizes.items())]
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _snapshot = None
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    if _snapshot is None:
+        lines.append("Started tracing; request again to see the growth.")
+    else:
+        lines.append("Top " + str(limit) + " growths since last snapshot:")
+        statistics = snapshot.compare_to(_snapshot, "lineno")
+        lines.extend(str(statistic) for statistic in statistics[:limit])
+    _snapshot = snapshot
+
+    if stop:
+        tracemalloc.stop()
+        _snapshot = None
+        lines.append("Stopped tracing.")
+    return "\n".join(lines) + "\n"
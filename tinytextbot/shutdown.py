@@ -0,0 +1,71 @@
+import logging
+import os
+import signal
+import threading
+
+from tinytextbot.deadline import Deadline
+
+# Seconds allowed for in-flight work to finish after a SIGTERM.
+GRACE_PERIOD = float(os.environ.get("SHUTDOWN_GRACE_PERIOD", "20"))
+
+_stopping = threading.Event()
+
+
+# Returns whether new updates should be refused as the process is stopping.
+def stopping():
+    return _stopping.is_set()
+
+
+# Stops accepting updates, then calls drain with a deadline for the grace
+# period. drain should finish or abandon all outstanding work, and return a
+# dict describing what it drained and abandoned, which is logged and returned.
+def shut_down(drain, grace_period=None):
+    if grace_period is None:
+        grace_period = GRACE_PERIOD
+
+    logger = logging.getLogger("shutdown")
+    _stopping.set()
+    logger.info("Shutting down within " + str(grace_period) + " seconds.")
+    report = drain(Deadline(grace_period))
+    logger.info("Shut down: " +
+                ", ".join(name + " " + str(count)
+                          for name, count in sorted(report.items())) + ".")
+    return report
+
+
+# Ends the process once it has shut down, from any thread.
+def exit_process(status=0):
+    logging.shutdown()
+    os._exit(status)
+
+
+# Stops accepting updates at once, then shuts down with drain on a new
+# thread, which calls exit when done. Returns the thread.
+# The calling thread is free to finish its own request and refuse new ones.
+def shut_down_in_background(drain, grace_period=None, exit=exit_process):
+    _stopping.set()
+
+    def run():
+        shut_down(drain, grace_period)
+        exit(0)
+
+    thread = threading.Thread(target=run, name="shutdown")
+    thread.start()
+    return thread
+
+
+# Shuts down with drain when a SIGTERM is received, then exits.
+# The handler interrupts the main thread, which may be serving a request and
+# holding locks that drain needs, so it only starts the shutdown thread.
+# Signal handlers can only be installed from the main thread, so this does
+# nothing elsewhere, such as when the application is imported by a worker.
+def install(drain):
+    if threading.current_thread() is not threading.main_thread():
+        return False
+
+    def handle_sigterm(signal_number, frame):
+        if not stopping():
+            shut_down_in_background(drain)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    return True
@@ -1,4 +1,5 @@
 import logging
+import threading
 import time
 
 from sortedcontainers import SortedDict
@@ -9,8 +10,18 @@ class SortedDictWithMaxSize(SortedDict):
         super().__init__()
         self.name = name
         self.max_size = max_size
+        # Updates may be tracked from several worker threads at once.
+        self.lock = threading.RLock()
+
+    def contains_value(self, value):
+        with self.lock:
+            return value in self.values()
 
     def add(self, value):
+        with self.lock:
+            self._add(value)
+
+    def _add(self, value):
         current_size = len(self)
         logger = logging.getLogger(self.name)
         logger.debug("Current size is " + str(current_size) + ".")
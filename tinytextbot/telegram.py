@@ -1,22 +1,39 @@
-import json
 import logging
 import os
 from enum import Enum
 
 import requests
 
+from tinytextbot import codec, connections, metrics, tracing
+
 
 class Result(object):
+    TYPE = "article"
+    ID = "0"
+    TITLE = "Choose this to send your tiny text!"
+
+    # Every result shares the same type, id and title, so they are encoded
+    # once and only the converted text is encoded per result.
+    _encoded_prefix = codec.encode_object(
+        {"type": TYPE, "id": ID, "title": TITLE})[:-1]
+
     def __init__(self, result):
         super().__init__()
-        self.type = "article"
-        self.id = "0"
-        self.title = "Choose this to send your tiny text!"
+        self.type = self.TYPE
+        self.id = self.ID
+        self.title = self.TITLE
         self.description = result
         self.input_message_content = {"message_text": result}
 
+    def encode(self):
+        encoded_result = codec.dumps(self.description)
+        return codec.Encoded(self._encoded_prefix +
+                             b',"description":' + encoded_result +
+                             b',"input_message_content":{"message_text":' +
+                             encoded_result + b"}}")
+
     def to_json(self):
-        return json.dumps(self.__dict__, ensure_ascii=False)
+        return self.encode().value.decode("utf-8")
 
 
 class Update(object):
@@ -49,10 +66,15 @@ class Update(object):
         START = "/start"
 
 
+def get_api_base(token):
+    return "https://api.telegram.org/bot" + token + "/"
+
+
 TOKEN = os.environ["TELEGRAM_TOKEN"]
-api_base = "https://api.telegram.org/bot" + TOKEN + "/"
+api_base = get_api_base(TOKEN)
 api_send_message = api_base + "sendMessage"
 api_answer_inline_query = api_base + "answerInlineQuery"
+json_headers = {"Content-Type": "application/json"}
 
 
 # Unwraps Telegrams's response and returns a boolean successful and
@@ -61,7 +83,7 @@ def check_response(response):
     successful = False
     response_text = ""
     if response:
-        response_json = response.json()
+        response_json = codec.loads(response.content)
         successful = response_json[Update.Field.SUCCESSFUL.value]
         if not successful:
             response_text = response_json[Update.Field.DESCRIPTION.value]
@@ -69,15 +91,32 @@ def check_response(response):
 
 
 # Sends json_data to the destination with a connection_timeout.
+# json_data may be a dict, or bytes that have already been encoded as JSON.
+# If a deadline is given, the timeout is limited to its remaining budget,
+# and nothing is sent once it has expired.
 # Catches common possible connection errors and logs them with error_message.
-def post(destination, json_data, error_message, connection_timeout=7):
+def post(destination, json_data, error_message, connection_timeout=7,
+         deadline=None):
     response = None
     logger = logging.getLogger("connection")
 
+    if deadline:
+        connection_timeout = deadline.timeout(connection_timeout)
+        if connection_timeout <= 0:
+            logger.info("Deadline exceeded before sending. " + error_message)
+            metrics.increment("telegram.deadline_exceeded")
+            return response
+
+    if not isinstance(json_data, bytes):
+        json_data = codec.dumps(json_data)
+
     try:
-        response = requests.post(destination,
-                                 json=json_data,
-                                 timeout=connection_timeout)
+        # The destination contains the token, so only the method is traced.
+        with tracing.span("telegram", method=destination.rsplit("/", 1)[-1]):
+            response = connections.session.post(destination,
+                                                data=json_data,
+                                                headers=json_headers,
+                                                timeout=connection_timeout)
         response.raise_for_status()
     except requests.Timeout:
         logger.info("Timed out after " + str(connection_timeout) +
@@ -88,7 +127,7 @@ def post(destination, json_data, error_message, connection_timeout=7):
         logger.info("HTTP request failed with error code " +
                     str(response.status_code) + ". " + error_message)
     finally:
-        logger.debug(str(json_data))
+        logger.debug(json_data.decode("utf-8"))
 
     return response
 
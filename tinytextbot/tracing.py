@@ -0,0 +1,148 @@
+import contextlib
+import functools
+import logging
+import os
+import random
+import threading
+import time
+
+from tinytextbot import codec
+
+# Fraction of updates to trace, from 0 (none) to 1 (all).
+SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+# Spans are written one per line in Zipkin's v2 JSON format.
+# If TRACE_LOCATION is not set, they are written to the application log.
+LOCATION = os.environ.get("TRACE_LOCATION")
+
+_local = threading.local()
+
+
+class Trace(object):
+    def __init__(self, sampled, trace_id=None, parent_id=None):
+        super().__init__()
+        self.trace_id = trace_id or new_id()
+        self.sampled = sampled
+        self.parents = [parent_id] if parent_id else []
+        self.tags = {}
+
+    # Returns what another thread needs to continue this trace from the
+    # innermost open span.
+    def context(self):
+        parent_id = self.parents[-1] if self.parents else None
+        return self.trace_id, self.sampled, parent_id
+
+
+def new_id():
+    return "%016x" % random.getrandbits(64)
+
+
+def setup_logger(location=LOCATION):
+    logger = logging.getLogger("trace")
+    if location:
+        handler = logging.FileHandler(location)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    return logger
+
+
+logger = setup_logger()
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+# Starts a trace for one update on the current thread.
+# The trace is sampled with probability SAMPLE_RATE; unsampled traces
+# only cost a random number and a thread-local lookup per span.
+@contextlib.contextmanager
+def trace(name, sample_rate=None):
+    if sample_rate is None:
+        sample_rate = SAMPLE_RATE
+
+    previous = current_trace()
+    _local.trace = Trace(random.random() < sample_rate)
+    try:
+        with span(name):
+            yield _local.trace
+    finally:
+        _local.trace = previous
+
+
+# Continues a trace started on another thread, given its context, so that
+# the enclosed spans share its id and sampling decision. If there is no
+# context, a new trace is started instead.
+@contextlib.contextmanager
+def resume(name, context):
+    if context is None:
+        with trace(name) as current:
+            yield current
+        return
+
+    trace_id, sampled, parent_id = context
+    previous = current_trace()
+    _local.trace = Trace(sampled, trace_id, parent_id)
+    try:
+        with span(name):
+            yield _local.trace
+    finally:
+        _local.trace = previous
+
+
+# Returns the context of the current trace, or None outside of a trace.
+def current_context():
+    current = current_trace()
+    return current.context() if current else None
+
+
+# Times the enclosed block as a child of the innermost open span.
+@contextlib.contextmanager
+def span(name, **tags):
+    current = current_trace()
+    if current is None or not current.sampled:
+        yield
+        return
+
+    span_id = new_id()
+    parent_id = current.parents[-1] if current.parents else None
+    current.parents.append(span_id)
+    timestamp = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        current.parents.pop()
+        if parent_id is None:
+            tags.update(current.tags)
+        record(current.trace_id, span_id, parent_id, name,
+               timestamp, duration, tags)
+
+
+# Attaches a tag to the root span of the current trace.
+def tag(key, value):
+    current = current_trace()
+    if current is not None and current.sampled:
+        current.tags[key] = str(value)
+
+
+def record(trace_id, span_id, parent_id, name, timestamp, duration, tags):
+    encoded_span = {"traceId": trace_id,
+                    "id": span_id,
+                    "name": name,
+                    "timestamp": int(timestamp * 1e6),
+                    "duration": int(duration * 1e6),
+                    "tags": {key: str(value) for key, value in tags.items()}}
+    if parent_id is not None:
+        encoded_span["parentId"] = parent_id
+    logger.info(codec.dumps(encoded_span).decode("utf-8"))
+
+
+# Runs the decorated function inside a new trace named after it.
+def traced(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with trace(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,139 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from tinytextbot import metrics, tracing
+
+# Number of background workers. If 0, updates are handled before the webhook
+# returns; else the webhook returns as soon as the update is queued.
+WORKERS = int(os.environ.get("WORKERS", "0"))
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", "100"))
+# Seconds to wait for space in a full queue before rejecting an update.
+QUEUE_TIMEOUT = float(os.environ.get("QUEUE_TIMEOUT", "0.5"))
+
+
+# Each worker has its own queue, and jobs are sharded across the queues by a
+# key such as the user id. Jobs with the same key are therefore handled in
+# the order they were submitted, while different keys are handled in parallel.
+class WorkerPool(object):
+    def __init__(self, name, workers=WORKERS, queue_size=QUEUE_SIZE,
+                 queue_timeout=QUEUE_TIMEOUT):
+        super().__init__()
+        self.name = name
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.queues = [queue.Queue(maxsize=queue_size)
+                       for _ in range(workers)]
+        self.threads = []
+        # Whether each worker is running a job.
+        self.busy = [False] * workers
+
+    def start(self):
+        for number, jobs in enumerate(self.queues):
+            thread = threading.Thread(target=self.run,
+                                      args=(number, jobs),
+                                      name=self.name + "." + str(number),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logging.getLogger(self.name).info(
+            "Started " + str(self.workers) + " workers.")
+
+    def shard(self, key):
+        return hash(key) % self.workers
+
+    # Returns the number of jobs waiting across all the queues.
+    def depth(self):
+        return sum(jobs.qsize() for jobs in self.queues)
+
+    # Queues function to be called with args and kwargs by the worker that
+    # key is sharded to.
+    # Returns False if its queue stayed full for queue_timeout seconds,
+    # in which case the caller should ask Telegram to retry later.
+    def submit(self, key, function, *args, **kwargs):
+        number = self.shard(key)
+        jobs = self.queues[number]
+        try:
+            jobs.put((time.monotonic(), tracing.current_context(), function,
+                      args, kwargs),
+                     timeout=self.queue_timeout)
+        except queue.Full:
+            logging.getLogger(self.name).info(
+                "Queue " + str(number) + " is full.")
+            metrics.increment(self.name + ".rejected")
+            return False
+        metrics.set_gauge(self.name + ".depth." + str(number), jobs.qsize())
+        return True
+
+    def run(self, number, jobs):
+        logger = logging.getLogger(self.name)
+        while True:
+            job = jobs.get()
+            if job is None:
+                jobs.task_done()
+                break
+
+            queued_at, trace_context, function, args, kwargs = job
+            metrics.observe(self.name + ".wait", time.monotonic() - queued_at)
+            metrics.set_gauge(self.name + ".depth." + str(number),
+                              jobs.qsize())
+            self.busy[number] = True
+            try:
+                with tracing.resume(function.__name__, trace_context):
+                    function(*args, **kwargs)
+            except Exception:
+                logger.exception("Job " + function.__name__ + " failed.")
+            finally:
+                self.busy[number] = False
+                jobs.task_done()
+
+    # Returns the number of jobs being run.
+    def running(self):
+        return sum(self.busy)
+
+    # Returns the number of jobs not yet started, excluding stop signals.
+    def waiting(self):
+        count = 0
+        for jobs in self.queues:
+            with jobs.mutex:
+                count += sum(1 for job in jobs.queue if job is not None)
+        return count
+
+    # Lets the workers finish the queued jobs, then stops them.
+    def stop(self):
+        self.drain()
+
+    # Lets the workers finish the running and queued jobs for at most timeout
+    # seconds, then stops them. Returns the number of those jobs that were
+    # finished, the number abandoned in a queue, and the number abandoned
+    # while running.
+    def drain(self, timeout=None):
+        expires_at = None
+        if timeout is not None:
+            expires_at = time.monotonic() + timeout
+
+        def remaining():
+            if expires_at is None:
+                return None
+            return max(0.0, expires_at - time.monotonic())
+
+        outstanding = self.waiting() + self.running()
+        for jobs in self.queues:
+            try:
+                jobs.put(None, timeout=remaining())
+            except queue.Full:
+                pass
+        for thread in self.threads:
+            thread.join(remaining())
+
+        abandoned_queued = self.waiting()
+        abandoned_running = self.running()
+        finished = outstanding - abandoned_queued - abandoned_running
+        self.threads = []
+        logging.getLogger(self.name).info(
+            "Finished " + str(finished) + " jobs, and abandoned " +
+            str(abandoned_queued) + " queued and " + str(abandoned_running) +
+            " running jobs.")
+        return finished, abandoned_queued, abandoned_running